@@ -0,0 +1,263 @@
+"""End-to-end benchmark of the watcher -> upload -> download -> QR path.
+
+Generates synthetic CR-sized DICOM files, serves webapp/app.py on a local
+port and copies the files into a directory watched by the monitoring client
+from hospital_SW/app.py. Once every upload has been ingested it downloads
+the files, previews, QR codes and study ZIPs. It then prints the latencies
+together with the server's /metrics and the client's upload counters.
+
+    python benchmark/run_benchmark.py --files 20
+    python benchmark/run_benchmark.py --mongo-uri mongodb://localhost:27017/ --files 50 --output bench.json
+
+Without --mongo-uri the server runs on mongomock (pip install mongomock), an
+in-memory stand-in for MongoDB and GridFS. With a real MongoDB the
+benchmark uses its own database, which is dropped afterwards.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.1'
+BENCHMARK_DB = 'dicom_benchmark'
+
+
+def make_cr_file(path, rows, cols, patient_id, study_uid, rng):
+    """Write a 12-bit monochrome CR image with a gradient and noise."""
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CR_IMAGE_STORAGE
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.preamble = b'\0' * 128
+    ds.SOPClassUID = CR_IMAGE_STORAGE
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = generate_uid()
+    ds.Modality = 'CR'
+    ds.PatientName = f'Benchmark^{patient_id}'
+    ds.PatientID = patient_id
+    ds.PatientBirthDate = '19800101'
+    ds.PatientSex = 'O'
+    ds.Rows = rows
+    ds.Columns = cols
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    ds.WindowCenter = 2048
+    ds.WindowWidth = 4096
+
+    gradient = np.linspace(0, 3000, cols, dtype=np.float32)[np.newaxis, :]
+    noise = rng.normal(0, 200, (rows, cols)).astype(np.float32)
+    ds.PixelData = np.clip(gradient + noise, 0, 4095).astype(np.uint16).tobytes()
+    ds.save_as(path, enforce_file_format=True)
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # Flask locates templates through sys.modules
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def use_in_memory_mongo():
+    import mongomock
+    import mongomock.gridfs
+    import pymongo
+
+    mongomock.gridfs.enable_gridfs_integration()
+    in_memory = mongomock.MongoClient()
+    pymongo.MongoClient = lambda *args, **kwargs: in_memory
+
+
+def summarize(latencies):
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+    return {
+        'count': len(ordered),
+        'p50_ms': round(statistics.median(ordered) * 1000, 3),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+
+def fetch_all(session, base_url, paths, headers=None):
+    """GET every path, reading each body to the end. Returns (latencies, bytes)."""
+    latencies = []
+    total_bytes = 0
+    for path in paths:
+        start = time.perf_counter()
+        response = session.get(base_url + path, headers=headers, stream=True)
+        for chunk in response.iter_content(256 * 1024):
+            total_bytes += len(chunk)
+        latencies.append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            raise RuntimeError(f'GET {path} returned {response.status_code}')
+    return latencies, total_bytes
+
+
+class PrintSignal:
+    """Stands in for the Qt signal the watcher reports new files on."""
+
+    def emit(self, message):
+        pass
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='dicom_bench_')
+    source_dir = os.path.join(work_dir, 'source')
+    watch_dir = os.path.join(work_dir, 'watch')
+    os.makedirs(source_dir)
+    os.makedirs(watch_dir)
+
+    if args.mongo_uri:
+        os.environ['MONGO_URI'] = args.mongo_uri
+    else:
+        use_in_memory_mongo()
+    os.environ['MONGO_DB'] = BENCHMARK_DB
+    os.environ['INGEST_WORKERS'] = str(args.ingest_workers)
+    os.environ['QR_CACHE_DIR'] = os.path.join(work_dir, 'qr_cache')
+    os.environ['UPLOAD_WORKERS'] = str(args.upload_workers)
+    os.environ['UPLOAD_MANIFEST'] = os.path.join(work_dir, 'manifest.sqlite3')
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+    webapp = load_module('webapp_app', os.path.join(ROOT, 'webapp', 'app.py'))
+    webapp.jobs.delete_many({})
+    webapp.collection.delete_many({})
+
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, webapp.app, threaded=True)
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ['UPLOAD_URL'] = base_url + '/upload'
+    webapp.app.config['DOWNLOAD_BASE_URL'] = base_url
+
+    monitor = load_module('monitor_app', os.path.join(ROOT, 'hospital_SW', 'app.py'))
+    results = {'files': args.files, 'rows': args.rows, 'cols': args.cols}
+
+    try:
+        # Synthetic scanner output, several instances per study
+        rng = np.random.default_rng(args.seed)
+        start = time.perf_counter()
+        filenames = []
+        study_uids = []
+        for i in range(args.files):
+            if i % args.per_study == 0:
+                study_uids.append(generate_uid())
+            filename = f'bench_{i:05d}.dcm'
+            make_cr_file(os.path.join(source_dir, filename), args.rows, args.cols,
+                         f'BENCH{i // args.per_study:04d}', study_uids[-1], rng)
+            filenames.append(filename)
+        results['generate_seconds'] = round(time.perf_counter() - start, 3)
+        results['file_bytes'] = os.path.getsize(os.path.join(source_dir, filenames[0]))
+
+        # Watcher -> upload -> ingest
+        manifest = monitor.UploadManifest(os.environ['UPLOAD_MANIFEST'])
+        uploader = monitor.Uploader(PrintSignal(), manifest, workers=args.upload_workers)
+        handler = monitor.FileEventHandler(uploader)
+        observer = monitor.Observer()
+        observer.schedule(handler, watch_dir, recursive=False)
+        observer.start()
+
+        start = time.perf_counter()
+        for filename in filenames:
+            shutil.copyfile(os.path.join(source_dir, filename), os.path.join(watch_dir, filename))
+        deadline = time.monotonic() + args.timeout
+        while webapp.jobs.count_documents({'status': {'$in': ['done', 'duplicate', 'failed']}}) < args.files:
+            if time.monotonic() > deadline:
+                raise RuntimeError('Timed out waiting for uploads to be ingested')
+            time.sleep(0.05)
+        ingest_seconds = time.perf_counter() - start
+        observer.stop()
+        observer.join()
+        results['ingest'] = {
+            'seconds': round(ingest_seconds, 3),
+            'files_per_second': round(args.files / ingest_seconds, 3),
+            'failed': webapp.jobs.count_documents({'status': 'failed'}),
+        }
+        results['client'] = uploader.stats.snapshot()
+        # Shows up under 'clients' in the server's /metrics below
+        uploader.report_stats()
+        uploader.shutdown()
+
+        # Startup catch-up scan over a directory that is already fully uploaded
+        start = time.perf_counter()
+        remaining = list(monitor.find_new_or_changed(watch_dir, manifest))
+        results['reconcile_scan'] = {'seconds': round(time.perf_counter() - start, 3),
+                                     'files_to_upload': len(remaining)}
+        manifest.close()
+
+        # Download, QR and preview paths as seen by patients and reception
+        session = monitor.create_session(1)
+        latencies, nbytes = fetch_all(session, base_url, [f'/download/{f}' for f in filenames])
+        results['download'] = dict(summarize(latencies), bytes=nbytes,
+                                   mb_per_second=round(nbytes / sum(latencies) / 1e6, 3))
+        half = results['file_bytes'] // 2
+        latencies, _ = fetch_all(session, base_url, [f'/download/{f}' for f in filenames],
+                                 headers={'Range': f'bytes={half}-'})
+        results['download_resume'] = summarize(latencies)
+        latencies, _ = fetch_all(session, base_url, [f'/qr/{f}.png' for f in filenames])
+        results['qr_cold'] = summarize(latencies)
+        latencies, _ = fetch_all(session, base_url, [f'/qr/{f}.png' for f in filenames])
+        results['qr_warm'] = summarize(latencies)
+        latencies, _ = fetch_all(session, base_url, ['/print_qr'])
+        results['print_sheet'] = summarize(latencies)
+        latencies, nbytes = fetch_all(session, base_url, [f'/preview/{f}/image' for f in filenames])
+        results['preview'] = dict(summarize(latencies), bytes=nbytes)
+        latencies, nbytes = fetch_all(session, base_url, [f'/study/{uid}/download' for uid in study_uids])
+        results['study_zip'] = dict(summarize(latencies), bytes=nbytes)
+        latencies, _ = fetch_all(session, base_url, ['/'])
+        results['file_list'] = summarize(latencies)
+        results['server'] = session.get(base_url + '/metrics').json()
+        session.close()
+    finally:
+        server.shutdown()
+        if args.mongo_uri:
+            webapp.client.drop_database(BENCHMARK_DB)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=20, help='number of DICOM files to push through')
+    parser.add_argument('--rows', type=int, default=2500, help='image rows (default: CR-sized)')
+    parser.add_argument('--cols', type=int, default=2048, help='image columns (default: CR-sized)')
+    parser.add_argument('--per-study', type=int, default=2, help='instances per study')
+    parser.add_argument('--upload-workers', type=int, default=4)
+    parser.add_argument('--ingest-workers', type=int, default=2)
+    parser.add_argument('--mongo-uri', help='MongoDB to run against instead of the in-memory stand-in')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for ingestion')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = run(args)
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,66 +1,324 @@
 import sys
 import time
+import hashlib
+import random
+import socket
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QPushButton, QFileDialog, QLabel, QSystemTrayIcon, QMenu
 from PyQt5.QtGui import QIcon
 from PyQt5.QtCore import QThread, pyqtSignal
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import threading
-from queue import Queue, Empty
 import pydicom
 import requests
+from requests.adapters import HTTPAdapter
 import os
 
+UPLOAD_URL = os.environ.get('UPLOAD_URL', 'http://127.0.0.1:5000/upload')
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', '4'))
+UPLOAD_TIMEOUT = 60
+UPLOAD_MAX_RETRIES = 5
+UPLOAD_BACKOFF = 1.0
+UPLOAD_BACKOFF_MAX = 60.0
+# Client errors that only mean "not now"; retried like server errors
+UPLOAD_RETRY_STATUSES = {408, 429}
+# Files still pending after their retries are resubmitted this often
+PENDING_RETRY_INTERVAL = 60
+# Upload counters are sent to the server's /metrics this often
+METRICS_URL = os.environ.get('METRICS_URL', UPLOAD_URL.rsplit('/', 1)[0] + '/metrics/client')
+METRICS_REPORT_INTERVAL = 60
+CLIENT_NAME = os.environ.get('CLIENT_NAME', socket.gethostname())
+MANIFEST_PATH = os.environ.get('UPLOAD_MANIFEST', os.path.join(os.path.expanduser('~'), '.dicom_upload_manifest.sqlite3'))
+# A file is uploaded once its size and mtime are unchanged for this many seconds
+STABLE_INTERVAL = 1.0
+HASH_CHUNK_SIZE = 1024 * 1024
+
 def extract_patient_info(dicom_file_path):
-    ds = pydicom.dcmread(dicom_file_path)
+    # Only the header is needed; stop before the multi-megabyte pixel data
+    ds = pydicom.dcmread(dicom_file_path, stop_before_pixels=True)
     patient_name = str(ds.PatientName) if 'PatientName' in ds else 'Unknown'
     patient_id = str(ds.PatientID) if 'PatientID' in ds else 'Unknown'
     patient_birth_date = str(ds.PatientBirthDate) if 'PatientBirthDate' in ds else 'Unknown'
     patient_sex = str(ds.PatientSex) if 'PatientSex' in ds else 'Unknown'
     return patient_name, patient_id, patient_birth_date, patient_sex
 
-def upload_file_to_flask(file_path):
-    url = 'http://127.0.0.1:5000/upload'
-    files = {'file': (os.path.basename(file_path), open(file_path, 'rb'))}
-    patient_info = extract_patient_info(file_path)
-    data = {
-        'patient_name': patient_info[0],
-        'patient_id': patient_info[1],
-        'patient_birth_date': patient_info[2],
-        'patient_sex': patient_info[3]
-    }
-    response = requests.post(url, files=files, data=data)
-    print(f"File {os.path.basename(file_path)} uploaded with response: {response.text}")
+def hash_file(file_path):
+    content_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+def create_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def upload_file_to_flask(file_path, patient_info, session=requests):
+    with open(file_path, 'rb') as f:
+        files = {'file': (os.path.basename(file_path), f)}
+        data = {
+            'patient_name': patient_info[0],
+            'patient_id': patient_info[1],
+            'patient_birth_date': patient_info[2],
+            'patient_sex': patient_info[3]
+        }
+        response = session.post(UPLOAD_URL, files=files, data=data, timeout=UPLOAD_TIMEOUT)
+    response.raise_for_status()
+    print(f"File {os.path.basename(file_path)} uploaded with response: {response.status_code}")
+    return response
+
+class UploadManifest:
+    """Persistent index of every file the watcher has seen: path, size, mtime,
+    hash and upload state ('pending', 'uploaded', 'rejected' or 'invalid').
+
+    Pending rows survive a crash or server outage and are resubmitted on the
+    next start and periodically while monitoring; the size/mtime columns let a startup scan skip files that
+    were already uploaded without reading them.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS files ('
+                        'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                        'sha256 TEXT, state TEXT, updated_at REAL)')
+        self.db.commit()
+
+    def stats(self):
+        """Return {path: (size, mtime_ns, state)} for every known file."""
+        with self.lock:
+            rows = self.db.execute('SELECT path, size, mtime_ns, state FROM files').fetchall()
+        return {path: (size, mtime_ns, state) for path, size, mtime_ns, state in rows}
+
+    def get(self, file_path):
+        with self.lock:
+            return self.db.execute('SELECT size, mtime_ns, sha256, state FROM files WHERE path = ?',
+                                   (file_path,)).fetchone()
+
+    def record(self, file_path, size, mtime_ns, sha256, state):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                            (file_path, size, mtime_ns, sha256, state, time.time()))
+            self.db.commit()
+
+    def set_state(self, file_path, state):
+        with self.lock:
+            self.db.execute('UPDATE files SET state = ?, updated_at = ? WHERE path = ?',
+                            (state, time.time(), file_path))
+            self.db.commit()
+
+    def pending(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT path FROM files WHERE state = 'pending'")]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def find_new_or_changed(directory, manifest):
+    """Yield the DICOM files in directory that still need uploading.
+
+    Only a stat per file is needed: files whose size and mtime match a
+    finished manifest row are skipped without being opened.
+    """
+    known = manifest.stats()
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.is_file() or not entry.name.lower().endswith('.dcm'):
+                continue
+            file_path = os.path.abspath(entry.path)
+            st = entry.stat()
+            row = known.get(file_path)
+            if row and row[:2] == (st.st_size, st.st_mtime_ns) and row[2] != 'pending':
+                continue
+            yield file_path
+
+class UploadStats:
+    """Counters for the client side of the pipeline: header parse time,
+    upload latency and bytes sent."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {'uploaded': 0, 'rejected': 0, 'failed': 0, 'retries': 0, 'bytes': 0}
+        self.timings = {}
+
+    def record(self, stage, seconds):
+        with self.lock:
+            count, total, longest = self.timings.get(stage, (0, 0.0, 0.0))
+            self.timings[stage] = (count + 1, total + seconds, max(longest, seconds))
+
+    def increment(self, counter, amount=1):
+        with self.lock:
+            self.counts[counter] += amount
+
+    def snapshot(self):
+        with self.lock:
+            timings = {stage: {'count': count, 'avg_ms': round(total * 1000 / count, 3), 'max_ms': round(longest * 1000, 3)}
+                       for stage, (count, total, longest) in self.timings.items()}
+            return {'counts': dict(self.counts), 'timings': timings}
+
+class Uploader:
+    """Uploads files on a worker pool that shares one pooled HTTP session."""
+
+    def __init__(self, signal, manifest, workers=UPLOAD_WORKERS):
+        self.signal = signal
+        self.manifest = manifest
+        self.session = create_session(workers)
+        self.stats = UploadStats()
+        self.lock = threading.Lock()
+        self.in_flight = set()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='uploader')
+
+    def submit(self, file_path):
+        with self.lock:
+            if file_path in self.in_flight:
+                return
+            self.in_flight.add(file_path)
+        self.executor.submit(self.process, file_path)
+
+    def resume(self):
+        # Files left pending by a crash, an outage or a previous directory
+        for file_path in self.manifest.pending():
+            if os.path.exists(file_path):
+                self.submit(file_path)
+            else:
+                self.manifest.set_state(file_path, 'invalid')
+
+    def process(self, file_path):
+        try:
+            self.upload(file_path)
+        except Exception as e:
+            print(f"Error uploading {file_path}: {e}")
+        finally:
+            with self.lock:
+                self.in_flight.discard(file_path)
+
+    def upload(self, file_path):
+        st = os.stat(file_path)
+        start = time.perf_counter()
+        content_hash = hash_file(file_path)
+        self.stats.record('hash', time.perf_counter() - start)
+        row = self.manifest.get(file_path)
+        if row and row[2] == content_hash and row[3] != 'pending':
+            # Touched but not changed: only the stat columns are refreshed
+            self.manifest.record(file_path, st.st_size, st.st_mtime_ns, content_hash, row[3])
+            return
+        self.manifest.record(file_path, st.st_size, st.st_mtime_ns, content_hash, 'pending')
+
+        try:
+            start = time.perf_counter()
+            patient_info = extract_patient_info(file_path)
+            self.stats.record('parse', time.perf_counter() - start)
+        except Exception as e:
+            print(f"Error reading {file_path}: {e}")
+            self.manifest.set_state(file_path, 'invalid')
+            return
+        message = f"New DICOM file: {os.path.basename(file_path)}, Patient Name: {patient_info[0]}, Patient ID: {patient_info[1]}, Birth Date: {patient_info[2]}, Sex: {patient_info[3]}"
+        self.signal.emit(message)
+
+        for attempt in range(UPLOAD_MAX_RETRIES + 1):
+            try:
+                start = time.perf_counter()
+                upload_file_to_flask(file_path, patient_info, self.session)
+                latency = time.perf_counter() - start
+                self.stats.record('upload', latency)
+                self.stats.increment('uploaded')
+                self.stats.increment('bytes', st.st_size)
+                self.manifest.set_state(file_path, 'uploaded')
+                return
+            except requests.HTTPError as e:
+                if e.response.status_code < 500 and e.response.status_code not in UPLOAD_RETRY_STATUSES:
+                    # Rejected by the server; sending it again will not help
+                    print(f"Upload of {file_path} rejected: {e}")
+                    self.stats.increment('rejected')
+                    self.manifest.set_state(file_path, 'rejected')
+                    return
+                error = e
+            except (requests.RequestException, OSError) as e:
+                error = e
+            if attempt == UPLOAD_MAX_RETRIES:
+                # Left pending in the manifest; the monitor loop resubmits it
+                print(f"Giving up on {file_path} after {attempt + 1} attempts: {error}")
+                self.stats.increment('failed')
+                return
+            delay = min(UPLOAD_BACKOFF * 2 ** attempt, UPLOAD_BACKOFF_MAX)
+            delay += random.uniform(0, delay / 2)
+            print(f"Upload of {file_path} failed ({error}), retrying in {delay:.1f}s")
+            self.stats.increment('retries')
+            time.sleep(delay)
+
+    def report_stats(self):
+        try:
+            response = self.session.post(METRICS_URL, json={'client': CLIENT_NAME, 'stats': self.stats.snapshot()},
+                                         timeout=UPLOAD_TIMEOUT)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            print(f"Could not report upload metrics: {e}")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
 
 class FileEventHandler(FileSystemEventHandler):
-    def __init__(self, signal):
+    """Collects DICOM files from watchdog events and hands each one to the
+    uploader once its size and mtime have stopped changing."""
+
+    def __init__(self, uploader):
         super().__init__()
-        self.signal = signal
-        self.buffer = Queue()
-        self.buffer_timeout = 2
-        self.last_event_time = time.time()
-        threading.Thread(target=self.process_buffer, daemon=True).start()
+        self.uploader = uploader
+        self.lock = threading.Lock()
+        # path -> (size, mtime_ns) seen at the previous check, None before the first
+        self.candidates = {}
+        self.stable_interval = STABLE_INTERVAL
+        threading.Thread(target=self.process_candidates, daemon=True).start()
+
+    def watch(self, file_path):
+        with self.lock:
+            self.candidates[os.path.abspath(file_path)] = None
 
     def on_created(self, event):
         if not event.is_directory and event.src_path.lower().endswith('.dcm'):
-            self.buffer.put(event.src_path)
-            self.last_event_time = time.time()
+            self.watch(event.src_path)
+
+    def on_modified(self, event):
+        self.on_created(event)
+
+    def on_moved(self, event):
+        if not event.is_directory and event.dest_path.lower().endswith('.dcm'):
+            self.watch(event.dest_path)
 
-    def process_buffer(self):
+    def process_candidates(self):
         while True:
             try:
-                time.sleep(self.buffer_timeout)
-                current_time = time.time()
-                if current_time - self.last_event_time >= self.buffer_timeout and not self.buffer.empty():
-                    while not self.buffer.empty():
-                        file_path = self.buffer.get()
-                        patient_info = extract_patient_info(file_path)
-                        message = f"New DICOM file: {os.path.basename(file_path)}, Patient Name: {patient_info[0]}, Patient ID: {patient_info[1]}, Birth Date: {patient_info[2]}, Sex: {patient_info[3]}"
-                        self.signal.emit(message)
-                        upload_file_to_flask(file_path)
-                    self.last_event_time = time.time()
+                time.sleep(self.stable_interval)
+                with self.lock:
+                    candidates = list(self.candidates.items())
+                for file_path, previous in candidates:
+                    try:
+                        st = os.stat(file_path)
+                        current = (st.st_size, st.st_mtime_ns)
+                    except FileNotFoundError:
+                        current = None
+                    with self.lock:
+                        if self.candidates.get(file_path, previous) != previous:
+                            # A new event arrived during the check; look again next round
+                            continue
+                        if current is None:
+                            self.candidates.pop(file_path, None)
+                            continue
+                        if current != previous or current[0] == 0:
+                            self.candidates[file_path] = current
+                            continue
+                        del self.candidates[file_path]
+                    self.uploader.submit(file_path)
             except Exception as e:
-                print(f"Error in process_buffer: {e}")
+                print(f"Error in process_candidates: {e}")
 
 class DirectoryMonitorThread(QThread):
     newFileSignal = pyqtSignal(str)
@@ -70,17 +328,33 @@ class DirectoryMonitorThread(QThread):
         self.directory = directory
 
     def run(self):
-        event_handler = FileEventHandler(self.newFileSignal)
+        manifest = UploadManifest(MANIFEST_PATH)
+        uploader = Uploader(self.newFileSignal, manifest)
+        event_handler = FileEventHandler(uploader)
         observer = Observer()
         observer.schedule(event_handler, self.directory, recursive=False)
+        # Watch first so nothing written during the catch-up scan is missed
         observer.start()
+        for file_path in find_new_or_changed(self.directory, manifest):
+            event_handler.watch(file_path)
+        uploader.resume()
+        last_retry = last_report = time.monotonic()
         try:
             while True:
                 time.sleep(1)
                 print("Monitoring...")
+                # Pick up files that gave up during a server restart or outage
+                if time.monotonic() - last_retry >= PENDING_RETRY_INTERVAL:
+                    uploader.resume()
+                    last_retry = time.monotonic()
+                if time.monotonic() - last_report >= METRICS_REPORT_INTERVAL:
+                    uploader.report_stats()
+                    last_report = time.monotonic()
         finally:
             observer.stop()
             observer.join()
+            uploader.shutdown()
+            manifest.close()
 
 class MainWindow(QWidget):
     def __init__(self):
@@ -1,31 +1,809 @@
-import base64
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 
-from flask import Flask, request, redirect, url_for, render_template, send_file
-from pymongo import MongoClient
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import Flask, request, url_for, render_template, send_file, Response, jsonify, g
+from markupsafe import Markup
+import numpy as np
+from PIL import Image
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
 import gridfs
 from pydicom import dcmread, dcmwrite
+from pydicom.uid import DeflatedExplicitVRLittleEndian
+try:
+    from pydicom.pixels import apply_modality_lut, apply_voi_lut
+except ImportError:  # pydicom < 3
+    from pydicom.pixel_data_handlers.util import apply_modality_lut, apply_voi_lut
 import qrcode
+import qrcode.image.svg
 import io
 from werkzeug.utils import secure_filename
 
 app = Flask(__name__)
+app.config['MONGO_URI'] = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
+app.config['MONGO_DB'] = os.environ.get('MONGO_DB', 'dicom_database')
+# Store files already anonymized at /upload time so downloads can be streamed
+# from GridFS as-is instead of being decoded and re-encoded on every QR scan.
+app.config['ANONYMIZE_ON_UPLOAD'] = os.environ.get('ANONYMIZE_ON_UPLOAD', '1') == '1'
+# Public address patients reach the server on (e.g. the ngrok URL); defaults to the request host
+app.config['DOWNLOAD_BASE_URL'] = os.environ.get('DOWNLOAD_BASE_URL', '')
+app.config['QR_CACHE_SIZE'] = int(os.environ.get('QR_CACHE_SIZE', '256'))
+app.config['QR_CACHE_DIR'] = os.environ.get('QR_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'dicom_qr_cache'))
+# Downsampled image generated at ingest for viewing on a phone: JPEG or WEBP
+app.config['PREVIEW_FORMAT'] = os.environ.get('PREVIEW_FORMAT', 'JPEG').upper()
+app.config['PREVIEW_MAX_SIZE'] = int(os.environ.get('PREVIEW_MAX_SIZE', '1024'))
+# Threads that process queued uploads; 0 leaves the queue to another process
+app.config['INGEST_WORKERS'] = int(os.environ.get('INGEST_WORKERS', '2'))
 
-client = MongoClient('mongodb://localhost:27017/')
-db = client['dicom_database']
+client = MongoClient(app.config['MONGO_URI'])
+db = client[app.config['MONGO_DB']]
 fs = gridfs.GridFS(db)
 collection = db['dicom_files']
+jobs = db['ingest_jobs']
 
 ALLOWED_EXTENSIONS = {'dcm'}
 
+# Number of files shown per page of the reception list
+PAGE_SIZE = 50
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Patient information removed from every DICOM file handed out through a QR code
+TAGS_TO_ANONYMIZE = ['PatientName', 'PatientID', 'PatientBirthDate', 'PatientSex',
+                     'PatientAge', 'PatientWeight', 'PatientAddress']
+
+# Size of the reads used to copy an upload into GridFS
+INGEST_CHUNK_SIZE = 256 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Ingest queue timings
+JOB_POLL_INTERVAL = 5
+JOB_STALE_AFTER = timedelta(minutes=10)
+JOB_RETENTION = timedelta(days=7)
+
+PREVIEW_MIMETYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp'}
+PREVIEW_QUALITY = 80
+
+QR_MIMETYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
+# Only versioned QR URLs (?v=<key>) are cached this long; see qr_response
+QR_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class QRCache:
+    """LRU cache of rendered QR images. Entries evicted from memory are
+    spilled to disk and promoted back on the next hit."""
+
+    def __init__(self, max_items, spill_dir):
+        self.max_items = max_items
+        self.spill_dir = spill_dir
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.spill_dir, key)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        self.put(key, data)
+        return data
+
+    def put(self, key, data):
+        with self.lock:
+            self.items[key] = data
+            self.items.move_to_end(key)
+            evicted = []
+            while len(self.items) > self.max_items:
+                evicted.append(self.items.popitem(last=False))
+        for old_key, old_data in evicted:
+            self._spill(old_key, old_data)
+
+    def _spill(self, key, data):
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not spill QR code {key} to disk: {e}")
+
+
+class Metrics:
+    """Call counts, elapsed time and bytes per processing stage, plus plain
+    event counters and the latest counters reported by each monitoring
+    client, served as JSON on /metrics."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.clients = {}
+
+    @contextmanager
+    def timed(self, stage):
+        # The block can set sample['bytes'] to count the bytes it moved
+        sample = {'bytes': 0}
+        start = time.perf_counter()
+        try:
+            yield sample
+        finally:
+            self.record(stage, time.perf_counter() - start, sample['bytes'])
+
+    def record(self, stage, seconds, nbytes=0):
+        with self.lock:
+            stats = self.stages.setdefault(stage, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes': 0})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['bytes'] += nbytes
+
+    def increment(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def report_client(self, name, stats):
+        with self.lock:
+            self.clients[name] = {'stats': stats, 'reported_at': datetime.now(timezone.utc).isoformat()}
+
+    def snapshot(self):
+        with self.lock:
+            stages = {
+                stage: {
+                    'count': stats['count'],
+                    'total_ms': round(stats['seconds'] * 1000, 3),
+                    'avg_ms': round(stats['seconds'] * 1000 / stats['count'], 3),
+                    'max_ms': round(stats['max_seconds'] * 1000, 3),
+                    'bytes': stats['bytes'],
+                }
+                for stage, stats in self.stages.items()
+            }
+            return {'stages': stages, 'counters': dict(self.counters), 'clients': dict(self.clients)}
+
+
+metrics = Metrics()
+qr_cache = QRCache(app.config['QR_CACHE_SIZE'], app.config['QR_CACHE_DIR'])
+# Set by /upload to wake idle ingest workers without waiting for the next poll
+jobs_waiting = threading.Event()
+# `python app.py` runs under the debug reloader, which executes this file in a
+# watcher process as well as in the child that serves requests. Only the
+# serving process (or any process importing the app) sets up the database
+# and runs ingest workers.
+SERVING_PROCESS = __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+
+
+def backfill_instance_fields():
+    """Record the instance UIDs and content hash of documents stored before
+    those fields existed, so clients re-sending old files get them deduplicated."""
+    count = 0
+    for doc in collection.find({'sop_instance_uid': {'$exists': False}},
+                               {'fs_id': 1, 'anonymized': 1, 'content_hash': 1}):
+        fields = {'sop_instance_uid': None}
+        try:
+            stored = fs.get(doc['fs_id'])
+            header = dcmread(stored, stop_before_pixels=True)
+            fields['sop_instance_uid'] = str(header.get('SOPInstanceUID', '')) or None
+            fields['study_instance_uid'] = str(header.get('StudyInstanceUID', '')) or None
+            # Anonymized copies no longer hash like the file the client sent
+            if not doc.get('anonymized') and not doc.get('content_hash'):
+                stored.seek(0)
+                content_hash = hashlib.sha256()
+                for chunk in iter(lambda: stored.read(INGEST_CHUNK_SIZE), b''):
+                    content_hash.update(chunk)
+                fields['content_hash'] = content_hash.hexdigest()
+        except Exception as e:
+            print(f"Could not read stored file of document {doc['_id']}: {e}")
+        # An instance stored twice keeps its UID on one document only, so the
+        # unique index below can still be built
+        sop_uid = fields['sop_instance_uid']
+        if sop_uid and collection.find_one({'sop_instance_uid': sop_uid}, {'_id': 1}):
+            fields['sop_instance_uid'] = None
+        try:
+            collection.update_one({'_id': doc['_id']}, {'$set': fields})
+        except DuplicateKeyError:
+            fields['sop_instance_uid'] = None
+            collection.update_one({'_id': doc['_id']}, {'$set': fields})
+        count += 1
+    if count:
+        print(f"Recorded instance UIDs of {count} older documents")
+
+
+def ensure_indexes():
+    # Documents stored before uploaded_at existed take it from their ObjectId
+    collection.update_many({'uploaded_at': {'$exists': False}},
+                           [{'$set': {'uploaded_at': {'$toDate': '$_id'}}}])
+    backfill_instance_fields()
+    collection.create_index([('filename', ASCENDING)])
+    collection.create_index([('uploaded_at', DESCENDING), ('_id', DESCENDING)])
+    collection.create_index([('patient_id', ASCENDING), ('uploaded_at', DESCENDING), ('_id', DESCENDING)])
+    # The database enforces one document per instance, so concurrent uploads of
+    # the same file cannot both pass the duplicate check in process_job
+    if 'sop_instance_uid_1' in collection.index_information():
+        collection.drop_index('sop_instance_uid_1')
+    try:
+        collection.create_index([('sop_instance_uid', ASCENDING)], name='sop_instance_uid_unique', unique=True,
+                                partialFilterExpression={'sop_instance_uid': {'$type': 'string'}})
+    except OperationFailure as e:
+        # Usually duplicates stored before the index existed; keep a plain index
+        print(f"Could not create unique index on sop_instance_uid: {e}")
+        collection.create_index([('sop_instance_uid', ASCENDING)])
+    collection.create_index([('content_hash', ASCENDING)])
+    collection.create_index([('study_instance_uid', ASCENDING), ('uploaded_at', ASCENDING)])
+    jobs.create_index([('status', ASCENDING), ('created_at', ASCENDING)])
+    jobs.create_index([('content_hash', ASCENDING)])
+    # Finished jobs expire; failed ones are kept along with their raw upload
+    jobs.create_index([('expire_at', ASCENDING)], expireAfterSeconds=0)
+
+
+if SERVING_PROCESS:
+    ensure_indexes()
+
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def public_url(endpoint, **values):
+    base_url = app.config['DOWNLOAD_BASE_URL']
+    if base_url:
+        return base_url.rstrip('/') + url_for(endpoint, **values)
+    return url_for(endpoint, _external=True, **values)
+
+
+def preview_url(filename):
+    return public_url('preview_page', filename=filename)
+
+
+def study_preview_url(study_uid):
+    return public_url('study_preview_page', study_uid=study_uid)
+
+
+def render_qr(data, fmt):
+    with metrics.timed('qr_render') as sample:
+        image = make_qr_image(data, fmt)
+        sample['bytes'] = len(image)
+    return image
+
+
+def make_qr_image(data, fmt):
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    img_io = io.BytesIO()
+    if fmt == 'svg':
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(img_io)
+    else:
+        qr.make_image(fill_color="black", back_color="white").save(img_io, 'PNG')
+    return img_io.getvalue()
+
+
+def qr_key(data, fmt):
+    return hashlib.sha256(f'{fmt}:{data}'.encode('utf-8')).hexdigest() + '.' + fmt
+
+
+def qr_version(data, fmt):
+    """Short version tag for QR image URLs; it changes whenever the encoded URL does."""
+    return qr_key(data, fmt)[:16]
+
+
+def get_qr(data, fmt):
+    """Return (key, image bytes) of the QR code for data, rendering it on a cache miss."""
+    key = qr_key(data, fmt)
+    image = qr_cache.get(key)
+    if image is None:
+        metrics.increment('qr_cache_miss')
+        image = render_qr(data, fmt)
+        qr_cache.put(key, image)
+    else:
+        metrics.increment('qr_cache_hit')
+    return key, image
+
+
+def qr_response(data, fmt):
+    key, image = get_qr(data, fmt)
+    # The encoded URL depends on DOWNLOAD_BASE_URL, so only a URL carrying the
+    # matching version may be cached for good; anything else is revalidated.
+    if request.args.get('v') == qr_version(data, fmt):
+        cache_control = f'public, max-age={QR_MAX_AGE}, immutable'
+    else:
+        cache_control = 'no-cache'
+    headers = {'ETag': f'"{key}"', 'Cache-Control': cache_control}
+    if request.if_none_match.contains(key):
+        return Response(status=304, headers=headers)
+    return Response(image, mimetype=QR_MIMETYPES[fmt], headers=headers)
+
+
+def inline_svg(image):
+    # The XML declaration is not allowed inside an HTML document
+    if image.startswith(b'<?xml'):
+        image = image.split(b'?>', 1)[1]
+    return Markup(image.decode('utf-8'))
+
+
+def encode_cursor(doc):
+    uploaded_at = doc['uploaded_at'].replace(tzinfo=timezone.utc)
+    millis = (uploaded_at - EPOCH) // timedelta(milliseconds=1)
+    return f"{millis}-{doc['_id']}"
+
+
+def decode_cursor(cursor):
+    millis, _, oid = cursor.partition('-')
+    return EPOCH + timedelta(milliseconds=int(millis)), ObjectId(oid)
+
+
+def day_range(date_text):
+    """Return the [start, end) of a YYYY-MM-DD day in the server's local time."""
+    day = datetime.strptime(date_text, '%Y-%m-%d')
+    return day.astimezone(), (day + timedelta(days=1)).astimezone()
+
+
+def anonymize_dataset(dicom_data):
+    for tag in TAGS_TO_ANONYMIZE:
+        if tag in dicom_data:
+            delattr(dicom_data, tag)
+    return dicom_data
+
+
+def save_upload(stream, filename):
+    """Copy an upload into GridFS as-is in chunks, computing its SHA-256 in
+    the same pass. Returns (fs_id, content_hash)."""
+    content_hash = hashlib.sha256()
+    with metrics.timed('gridfs_put') as sample, fs.new_file(filename=filename) as grid_in:
+        for chunk in iter(lambda: stream.read(INGEST_CHUNK_SIZE), b''):
+            content_hash.update(chunk)
+            grid_in.write(chunk)
+            sample['bytes'] += len(chunk)
+    return grid_in._id, content_hash.hexdigest()
+
+
+def store_anonymized(stream, header, pixel_offset, filename):
+    """Write an anonymized copy of a stored upload to GridFS and return its id.
+
+    header is the dataset read from stream with stop_before_pixels and
+    pixel_offset the position of its Pixel Data element.
+    """
+    stream.seek(0)
+    with metrics.timed('anonymize') as sample, fs.new_file(filename=filename) as grid_in:
+        transfer_syntax = header.file_meta.get('TransferSyntaxUID')
+        if transfer_syntax == DeflatedExplicitVRLittleEndian:
+            # The whole dataset is compressed, so there is no header to split off
+            dataset = anonymize_dataset(dcmread(stream))
+            stream = io.BytesIO()
+            dcmwrite(stream, dataset)
+            stream.seek(0)
+        else:
+            # Only the header is re-encoded; the pixel data is copied as-is
+            stream.seek(pixel_offset)
+            header_data = io.BytesIO()
+            dcmwrite(header_data, anonymize_dataset(header))
+            grid_in.write(header_data.getvalue())
+            sample['bytes'] += header_data.tell()
+        for chunk in iter(lambda: stream.read(INGEST_CHUNK_SIZE), b''):
+            grid_in.write(chunk)
+            sample['bytes'] += len(chunk)
+    return grid_in._id
+
+
+def window_pixels(dataset, pixels):
+    """Map stored pixel values to 8-bit display values.
+
+    Applies the modality LUT/rescale and then the VOI LUT or window
+    centre/width, all as whole-array NumPy operations.
+    """
+    pixels = apply_modality_lut(pixels, dataset)
+    if 'VOILUTSequence' in dataset:
+        pixels = apply_voi_lut(pixels, dataset).astype(np.float32)
+        low, high = pixels.min(), pixels.max()
+        pixels = (pixels - low) / max(high - low, 1)
+    elif 'WindowCenter' in dataset and 'WindowWidth' in dataset:
+        center = float(np.ravel(dataset.WindowCenter)[0])
+        width = max(float(np.ravel(dataset.WindowWidth)[0]), 1.0)
+        # Linear VOI function from PS3.3 C.11.2.1.2.1
+        pixels = np.clip((pixels.astype(np.float32) - (center - 0.5)) / max(width - 1, 1) + 0.5, 0, 1)
+    else:
+        pixels = pixels.astype(np.float32)
+        low, high = pixels.min(), pixels.max()
+        pixels = (pixels - low) / max(high - low, 1)
+
+    if dataset.get('PhotometricInterpretation') == 'MONOCHROME1':
+        pixels = 1 - pixels
+    return (pixels * 255 + 0.5).astype(np.uint8)
+
+
+def render_preview(dataset, max_size, fmt):
+    """Encode a downsampled, windowed preview of a monochrome image."""
+    if dataset.get('SamplesPerPixel', 1) != 1:
+        raise ValueError('Previews are only generated for monochrome images')
+    pixels = dataset.pixel_array
+    if pixels.ndim == 3:
+        # Multi-frame: preview the first frame
+        pixels = pixels[0]
+
+    # Block-average down to roughly the target size before windowing so the
+    # float work runs on the small array
+    step = max(pixels.shape) // max_size
+    if step > 1:
+        rows, cols = (pixels.shape[0] // step) * step, (pixels.shape[1] // step) * step
+        blocks = pixels[:rows, :cols].reshape(rows // step, step, cols // step, step)
+        # Back to the stored dtype so LUTs can still be indexed by pixel value
+        pixels = blocks.mean(axis=(1, 3)).astype(pixels.dtype)
+
+    img = Image.fromarray(window_pixels(dataset, pixels))
+    img.thumbnail((max_size, max_size), Image.LANCZOS)
+    img_io = io.BytesIO()
+    img.save(img_io, fmt, quality=PREVIEW_QUALITY)
+    return img_io.getvalue()
+
+
+def store_preview(fs_id, filename):
+    fmt = app.config['PREVIEW_FORMAT']
+    with metrics.timed('dicom_parse') as sample:
+        fs_file = fs.get(fs_id)
+        dataset = dcmread(fs_file)
+        sample['bytes'] = fs_file.length
+    with metrics.timed('preview_render') as sample:
+        preview = render_preview(dataset, app.config['PREVIEW_MAX_SIZE'], fmt)
+        sample['bytes'] = len(preview)
+    with metrics.timed('gridfs_put') as sample:
+        sample['bytes'] = len(preview)
+        return fs.put(preview, filename=f'{filename}.preview.{fmt.lower()}', contentType=PREVIEW_MIMETYPES[fmt])
+
+
+def update_job(job_id, **fields):
+    fields['updated_at'] = datetime.now(timezone.utc)
+    jobs.update_one({'_id': job_id}, {'$set': fields})
+
+
+def discard_job_output(job):
+    """Delete the stored copy and preview written for a job, unless an
+    indexed document already refers to them."""
+    for field in ('fs_id', 'preview_fs_id'):
+        file_id = job.get(field)
+        if file_id is not None and file_id != job['raw_fs_id'] \
+                and not collection.find_one({field: file_id}, {'_id': 1}):
+            fs.delete(file_id)
+
+
+def process_job(job):
+    """Turn a raw upload saved by /upload into a stored, indexed DICOM file.
+
+    The raw upload is only deleted once the document is inserted, so a job
+    that fails or whose worker dies can be run again from the start.
+    """
+    raw_fs_id = job['raw_fs_id']
+    filename = job['filename']
+    if job.get('fs_id') is not None and collection.find_one({'fs_id': job['fs_id']}, {'_id': 1}):
+        # Indexed by an earlier run of this job whose worker died before finishing
+        if job['fs_id'] != raw_fs_id:
+            fs.delete(raw_fs_id)
+        return 'done'
+    # Left behind by a worker that died while running this job
+    discard_job_output(job)
+
+    update_job(job['_id'], stage='parsing')
+    with metrics.timed('dicom_parse') as sample:
+        raw_file = fs.get(raw_fs_id)
+        header = dcmread(raw_file, stop_before_pixels=True)
+        # dcmread leaves the stream at the start of the Pixel Data element
+        pixel_offset = raw_file.tell()
+        sample['bytes'] = pixel_offset
+
+    sop_uid = str(header.get('SOPInstanceUID', '')) or None
+    with metrics.timed('mongo_query'):
+        duplicate = sop_uid and collection.find_one({'sop_instance_uid': sop_uid}, {'_id': 1})
+    if duplicate:
+        print(f"Skipping duplicate instance {sop_uid} in {filename}.")
+        fs.delete(raw_fs_id)
+        return 'duplicate'
+
+    # Nothing to rewrite unless anonymizing: the raw upload becomes the stored file
+    output = {'raw_fs_id': raw_fs_id, 'fs_id': raw_fs_id, 'preview_fs_id': None}
+    try:
+        if job['anonymize']:
+            update_job(job['_id'], stage='anonymizing')
+            output['fs_id'] = store_anonymized(raw_file, header, pixel_offset, filename)
+
+        update_job(job['_id'], stage='preview', fs_id=output['fs_id'])
+        try:
+            output['preview_fs_id'] = store_preview(output['fs_id'], filename)
+        except Exception as e:
+            # The DICOM file is still served without a preview
+            print(f"Could not generate preview for {filename}: {e}")
+
+        update_job(job['_id'], stage='indexing', preview_fs_id=output['preview_fs_id'])
+        with metrics.timed('mongo_insert'):
+            collection.insert_one({
+                'name': job['name'],
+                'patient_id': job['patient_id'],
+                'filename': filename,
+                'fs_id': output['fs_id'],  # Store the file's GridFS ID
+                'preview_fs_id': output['preview_fs_id'],
+                'anonymized': job['anonymize'],
+                'sop_instance_uid': sop_uid,
+                'study_instance_uid': str(header.get('StudyInstanceUID', '')) or None,
+                'content_hash': job['content_hash'],
+                'uploaded_at': job['created_at']
+            })
+    except DuplicateKeyError:
+        # Another worker stored the same instance after our duplicate check
+        print(f"Skipping duplicate instance {sop_uid} in {filename}.")
+        discard_job_output(output)
+        fs.delete(raw_fs_id)
+        return 'duplicate'
+    except Exception:
+        # The raw upload is kept so the failed job can be inspected or retried
+        discard_job_output(output)
+        raise
+    if output['fs_id'] != raw_fs_id:
+        fs.delete(raw_fs_id)
+    return 'done'
+
+
+def claim_job():
+    now = datetime.now(timezone.utc)
+    return jobs.find_one_and_update(
+        # Jobs left running by a worker that died are picked up again
+        {'$or': [{'status': 'queued'},
+                 {'status': 'running', 'updated_at': {'$lt': now - JOB_STALE_AFTER}}]},
+        {'$set': {'status': 'running', 'stage': 'claimed', 'started_at': now, 'updated_at': now}},
+        sort=[('created_at', ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def ingest_worker():
+    while True:
+        try:
+            job = claim_job()
+        except Exception as e:
+            print(f"Error claiming ingest job: {e}")
+            job = None
+        if job is None:
+            jobs_waiting.wait(JOB_POLL_INTERVAL)
+            jobs_waiting.clear()
+            continue
+        # Time the job spent in the queue before a worker picked it up
+        metrics.record('queue_wait', (job['started_at'] - job['created_at']).total_seconds())
+        try:
+            with metrics.timed('ingest_job'):
+                status = process_job(job)
+            metrics.increment(f'jobs_{status}')
+            now = datetime.now(timezone.utc)
+            update_job(job['_id'], status=status, stage=status, finished_at=now, expire_at=now + JOB_RETENTION)
+        except Exception as e:
+            metrics.increment('jobs_failed')
+            print(f"Error processing ingest job {job['_id']} ({job['filename']}): {e}")
+            update_job(job['_id'], status='failed', stage='failed', error=str(e),
+                       finished_at=datetime.now(timezone.utc))
+
+
+def start_ingest_workers():
+    for i in range(app.config['INGEST_WORKERS']):
+        threading.Thread(target=ingest_worker, name=f'ingest-{i}', daemon=True).start()
+
+
+if SERVING_PROCESS:
+    start_ingest_workers()
+
+
+def parse_range(range_header, length):
+    """Return (start, end) for a single-range 'bytes=' header, None if it should
+    be ignored and ValueError if it cannot be satisfied."""
+    match = RANGE_RE.match(range_header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if start == '':
+        # Suffix range: the last N bytes of the file
+        suffix = int(end)
+        if suffix == 0:
+            raise ValueError(range_header)
+        return max(length - suffix, 0), length - 1
+    start = int(start)
+    end = min(int(end), length - 1) if end else length - 1
+    if start >= length or start > end:
+        raise ValueError(range_header)
+    return start, end
+
+
+def iter_gridfs(fs_file, start, end):
+    """Yield bytes start..end (inclusive) of a GridFS file one chunk at a time."""
+    fs_file.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        with metrics.timed('gridfs_get') as sample:
+            data = fs_file.read(min(fs_file.chunk_size, remaining))
+            sample['bytes'] = len(data)
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+    fs_file.close()
+
+
+def anonymize_stored_file(fs_file):
+    """Anonymized copy of a file stored before anonymization moved to /upload."""
+    with metrics.timed('dicom_parse') as sample:
+        dicom_data = dcmread(fs_file)
+        sample['bytes'] = fs_file.length
+    with metrics.timed('anonymize') as sample:
+        anonymized_data = io.BytesIO()
+        dcmwrite(anonymized_data, anonymize_dataset(dicom_data))
+        sample['bytes'] = anonymized_data.tell()
+    anonymized_data.seek(0)
+    return anonymized_data
+
+
+class ZipStream:
+    """Unseekable file object that collects what zipfile writes so it can be
+    handed to the client piece by piece."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def iter_study_zip(file_docs):
+    """Yield a ZIP of the given files as it is built. Entries are stored
+    uncompressed: DICOM pixel data barely compresses and deflating it would
+    only cost CPU."""
+    stream = ZipStream()
+    names = set()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for file_doc in file_docs:
+            fs_file = fs.get(file_doc['fs_id'])
+            size = fs_file.length
+            if not file_doc.get('anonymized'):
+                fs_file = anonymize_stored_file(fs_file)
+                size = fs_file.getbuffer().nbytes
+
+            name = file_doc['filename']
+            stem, ext = os.path.splitext(name)
+            counter = 1
+            while name in names:
+                counter += 1
+                name = f'{stem}_{counter}{ext}'
+            names.add(name)
+
+            info = zipfile.ZipInfo(name, file_doc['uploaded_at'].timetuple()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            # Lets zipfile decide up front whether the entry needs ZIP64 fields
+            info.file_size = size
+            with archive.open(info, 'w') as entry:
+                while True:
+                    with metrics.timed('gridfs_get') as sample:
+                        chunk = fs_file.read(INGEST_CHUNK_SIZE)
+                        sample['bytes'] = len(chunk)
+                    if not chunk:
+                        break
+                    entry.write(chunk)
+                    yield stream.drain()
+            fs_file.close()
+    yield stream.drain()
+
+
+def stream_gridfs_file(fs_file, filename, mimetype='application/dicom', as_attachment=True):
+    length = fs_file.length
+    etag = str(fs_file._id)
+    disposition = 'attachment' if as_attachment else 'inline'
+    headers = {
+        'ETag': f'"{etag}"',
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': f'{disposition}; filename="{filename}"',
+        'Cache-Control': 'private, max-age=86400',
+    }
+
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    status = 200
+    start, end = 0, length - 1
+    range_header = request.headers.get('Range')
+    # A stale If-Range means the client's partial copy is of another file
+    if range_header and request.headers.get('If-Range', headers['ETag']) == headers['ETag']:
+        try:
+            byte_range = parse_range(range_header, length)
+        except ValueError:
+            headers['Content-Range'] = f'bytes */{length}'
+            return Response(status=416, headers=headers)
+        if byte_range:
+            start, end = byte_range
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{length}'
+
+    headers['Content-Length'] = str(end - start + 1)
+    return Response(iter_gridfs(fs_file, start, end), status=status,
+                    mimetype=mimetype, headers=headers, direct_passthrough=True)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    # Streamed responses are timed up to the first byte only
+    if request.endpoint and 'request_started' in g:
+        metrics.record(f'http_{request.endpoint}', time.perf_counter() - g.request_started,
+                       request.content_length or 0)
+    return response
+
+
 @app.route('/')
 def list_files():
-    files = list(collection.find({}, {'_id': 0, 'name': 1, 'patient_id': 1, 'filename': 1}))
-    return render_template('upload.html', files=files)
+    patient_id = request.args.get('patient_id', '').strip()
+    date = request.args.get('date', '').strip()
+    cursor = request.args.get('cursor', '')
+
+    conditions = []
+    if patient_id:
+        conditions.append({'patient_id': patient_id})
+    if date:
+        try:
+            start, end = day_range(date)
+        except (ValueError, OverflowError):
+            return 'Invalid date', 400
+        conditions.append({'uploaded_at': {'$gte': start, '$lt': end}})
+    if cursor:
+        try:
+            last_uploaded_at, last_id = decode_cursor(cursor)
+        except (ValueError, OverflowError, InvalidId):
+            return 'Invalid cursor', 400
+        # Keyset paging: everything strictly after the last row of the previous page
+        conditions.append({'$or': [
+            {'uploaded_at': {'$lt': last_uploaded_at}},
+            {'uploaded_at': last_uploaded_at, '_id': {'$lt': last_id}},
+        ]})
+    query = {'$and': conditions} if conditions else {}
+
+    with metrics.timed('mongo_query'):
+        files = list(collection.find(query, {'name': 1, 'patient_id': 1, 'filename': 1, 'uploaded_at': 1,
+                                             'study_instance_uid': 1})
+                     .sort([('uploaded_at', DESCENDING), ('_id', DESCENDING)])
+                     .limit(PAGE_SIZE + 1))
+    next_cursor = None
+    if len(files) > PAGE_SIZE:
+        files = files[:PAGE_SIZE]
+        next_cursor = encode_cursor(files[-1])
+    return render_template('upload.html', files=files, patient_id=patient_id, date=date,
+                           next_cursor=next_cursor)
 
 
 @app.route('/upload', methods=['POST'])
@@ -36,23 +814,65 @@ def upload_file():
     if file.filename == '' or not allowed_file(file.filename):
         return 'No selected file', 400
 
-    dicom_data = dcmread(file.stream)
-    # Add code to anonymize DICOM data here
-
-    binary_data = io.BytesIO()
-    dcmwrite(binary_data, dicom_data)
-    binary_data.seek(0)
+    # Only the raw bytes are saved here; parsing, anonymization and indexing
+    # happen on the ingest workers so the monitoring client is not kept waiting.
+    filename = secure_filename(file.filename)
+    raw_fs_id, content_hash = save_upload(file.stream, filename)
 
-    fs_id = fs.put(binary_data, filename=secure_filename(file.filename))
+    with metrics.timed('mongo_query'):
+        existing = jobs.find_one({'content_hash': content_hash, 'status': {'$in': ['queued', 'running', 'done']}},
+                                 {'_id': 1, 'status': 1})
+        duplicate = existing or collection.find_one({'content_hash': content_hash}, {'_id': 1})
+    if duplicate:
+        print(f"Skipping duplicate upload of {filename}.")
+        metrics.increment('uploads_duplicate')
+        fs.delete(raw_fs_id)
+        return jsonify(job_id=str(existing['_id']) if existing else None, status='duplicate'), 200
 
-    collection.insert_one({
+    now = datetime.now(timezone.utc)
+    job_id = jobs.insert_one({
+        'status': 'queued',
+        'stage': 'queued',
+        'filename': filename,
+        'raw_fs_id': raw_fs_id,
+        'content_hash': content_hash,
+        'anonymize': app.config['ANONYMIZE_ON_UPLOAD'],
         'name': request.form.get('patient_name', 'Unknown'),
         'patient_id': request.form.get('patient_id', 'Unknown'),
-        'filename': secure_filename(file.filename), # 이 줄을 추가
-        'fs_id': fs_id  # Store the file's GridFS ID
-    })
+        'created_at': now,
+        'updated_at': now
+    }).inserted_id
+    jobs_waiting.set()
 
-    return redirect(url_for('list_files'))
+    status_url = url_for('job_status', job_id=str(job_id))
+    metrics.increment('uploads_queued')
+    return jsonify(job_id=str(job_id), status='queued', status_url=status_url), 202, {'Location': status_url}
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    try:
+        job = jobs.find_one({'_id': ObjectId(job_id)})
+    except InvalidId:
+        job = None
+    if not job:
+        return jsonify(error='Job not found'), 404
+
+    result = {
+        'job_id': job_id,
+        'status': job['status'],
+        'stage': job['stage'],
+        'filename': job['filename'],
+        'created_at': job['created_at'].isoformat(),
+        'updated_at': job['updated_at'].isoformat(),
+    }
+    if 'finished_at' in job:
+        result['finished_at'] = job['finished_at'].isoformat()
+    if job['status'] == 'failed':
+        result['error'] = job.get('error')
+    if job['status'] == 'done':
+        result['download_url'] = url_for('download_file', filename=job['filename'])
+    return jsonify(result)
 
 
 @app.route('/download/<filename>')
@@ -63,7 +883,8 @@ def download_file(filename):
         return 'No filename provided', 400
 
     # Attempt to find the document in the database
-    file_doc = collection.find_one({'filename': filename})
+    with metrics.timed('mongo_query'):
+        file_doc = collection.find_one({'filename': filename})
     if not file_doc:
         print(f"File {filename} not found in the database.")
         return 'File not found', 404
@@ -71,21 +892,13 @@ def download_file(filename):
     # Attempt to retrieve the file from GridFS
     try:
         fs_file = fs.get(file_doc['fs_id'])
-        # Read the DICOM file into a pydicom Dataset
-        dicom_data = dcmread(fs_file)
 
-        # Anonymize the DICOM dataset (remove or replace patient information)
-        tags_to_anonymize = ['PatientName', 'PatientID', 'PatientBirthDate', 'PatientSex',
-                             'PatientAge', 'PatientWeight', 'PatientAddress']
+        # Files anonymized at upload time are sent straight from GridFS
+        if file_doc.get('anonymized'):
+            return stream_gridfs_file(fs_file, filename)
 
-        for tag in tags_to_anonymize:
-            if tag in dicom_data:
-                delattr(dicom_data, tag)
-
-        # Convert the anonymized dataset back to binary
-        anonymized_data = io.BytesIO()
-        dcmwrite(anonymized_data, dicom_data)
-        anonymized_data.seek(0)
+        # Anonymize the DICOM dataset (remove or replace patient information)
+        anonymized_data = anonymize_stored_file(fs_file)
 
         # Send the anonymized DICOM file as a response
         return send_file(
@@ -99,27 +912,129 @@ def download_file(filename):
         return 'Error downloading file', 500
 
 
+@app.route('/preview/<filename>')
+def preview_page(filename):
+    with metrics.timed('mongo_query'):
+        file_doc = collection.find_one({'filename': filename}, {'preview_fs_id': 1})
+    if not file_doc:
+        print(f"File {filename} not found in the database.")
+        return 'File not found', 404
+    return render_template('preview.html', filename=filename,
+                           has_preview=bool(file_doc.get('preview_fs_id')))
+
+
+@app.route('/study/<study_uid>')
+def study_preview_page(study_uid):
+    with metrics.timed('mongo_query'):
+        file_docs = list(collection.find({'study_instance_uid': study_uid},
+                                         {'_id': 0, 'filename': 1, 'preview_fs_id': 1})
+                         .sort([('uploaded_at', ASCENDING), ('_id', ASCENDING)]))
+    if not file_docs:
+        print(f"Study {study_uid} not found in the database.")
+        return 'Study not found', 404
+    return render_template('study_preview.html', study_uid=study_uid, files=file_docs)
+
+
+@app.route('/preview/<filename>/image')
+def preview_image(filename):
+    with metrics.timed('mongo_query'):
+        file_doc = collection.find_one({'filename': filename}, {'preview_fs_id': 1})
+    if not file_doc or not file_doc.get('preview_fs_id'):
+        return 'Preview not found', 404
+    try:
+        fs_file = fs.get(file_doc['preview_fs_id'])
+        return stream_gridfs_file(fs_file, fs_file.filename, mimetype=fs_file.content_type, as_attachment=False)
+    except Exception as e:
+        print(f"Error retrieving preview of {filename} from GridFS: {e}")
+        return 'Error loading preview', 500
+
+
+@app.route('/study/<study_uid>/download')
+def download_study(study_uid):
+    with metrics.timed('mongo_query'):
+        file_docs = list(collection.find({'study_instance_uid': study_uid},
+                                         {'filename': 1, 'fs_id': 1, 'anonymized': 1, 'uploaded_at': 1})
+                         .sort([('uploaded_at', ASCENDING), ('_id', ASCENDING)]))
+    if not file_docs:
+        print(f"Study {study_uid} not found in the database.")
+        return 'Study not found', 404
+
+    return Response(
+        iter_study_zip(file_docs),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{secure_filename(study_uid)}.zip"'}
+    )
+
+
 @app.route('/show_qr/<filename>')
 def show_qr(filename):
-    # 변경된 ngrok URL 사용
-    download_url = f'https://f367-61-81-223-102.ngrok-free.app/download/{filename}'
+    version = qr_version(preview_url(filename), 'png')
+    return render_template('show_qr.html', qr_src=url_for('qr_image', filename=filename, fmt='png', v=version))
+
+
+@app.route('/show_qr/study/<study_uid>')
+def show_study_qr(study_uid):
+    version = qr_version(study_preview_url(study_uid), 'png')
+    return render_template('show_qr.html',
+                           qr_src=url_for('study_qr_image', study_uid=study_uid, fmt='png', v=version))
+
+
+@app.route('/qr/<filename>.<any(png, svg):fmt>')
+def qr_image(filename, fmt):
+    return qr_response(preview_url(filename), fmt)
+
+
+@app.route('/qr/study/<study_uid>.<any(png, svg):fmt>')
+def study_qr_image(study_uid, fmt):
+    return qr_response(study_preview_url(study_uid), fmt)
+
+
+@app.route('/print_qr')
+def print_qr_sheet():
+    # One printable page with the QR codes of every file uploaded on a day (today by default)
+    date = request.args.get('date', '').strip() or datetime.now().strftime('%Y-%m-%d')
+    try:
+        start, end = day_range(date)
+    except (ValueError, OverflowError):
+        return 'Invalid date', 400
+
+    with metrics.timed('mongo_query'):
+        files = list(collection.find({'uploaded_at': {'$gte': start, '$lt': end}},
+                                     {'_id': 0, 'name': 1, 'patient_id': 1, 'filename': 1, 'study_instance_uid': 1})
+                     .sort([('uploaded_at', ASCENDING), ('_id', ASCENDING)]))
+    # One code per study; files without a StudyInstanceUID get their own
+    codes = []
+    seen_studies = set()
+    for file in files:
+        study_uid = file.get('study_instance_uid')
+        if study_uid:
+            if study_uid in seen_studies:
+                continue
+            seen_studies.add(study_uid)
+            url = study_preview_url(study_uid)
+        else:
+            url = preview_url(file['filename'])
+        codes.append(dict(file, qr_svg=inline_svg(get_qr(url, 'svg')[1])))
+    return render_template('qr_sheet.html', codes=codes, date=date)
+
+
+@app.route('/metrics')
+def show_metrics():
+    result = metrics.snapshot()
+    result['queue'] = {status: jobs.count_documents({'status': status})
+                       for status in ('queued', 'running', 'failed')}
+    return jsonify(result)
 
-    # 기존 QR 코드 생성 로직 유지
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(download_url)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    img_io = io.BytesIO()
-    img.save(img_io, 'PNG')
-    img_io.seek(0)
-    img_data = base64.b64encode(img_io.getvalue()).decode('utf-8')
-    return render_template('show_qr.html', qr_code_data=img_data)
 
+@app.route('/metrics/client', methods=['POST'])
+def report_client_metrics():
+    # Monitoring clients push their upload counters here; see hospital_SW/app.py
+    report = request.get_json(silent=True)
+    if not isinstance(report, dict) or not isinstance(report.get('client'), str) \
+            or not isinstance(report.get('stats'), dict):
+        return 'Invalid report', 400
+    metrics.report_client(report['client'][:255], report['stats'])
+    return '', 204
 
 
 if __name__ == "__main__":